@@ -8,12 +8,22 @@ from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 import os
 import asyncio
+import atexit
+import base64
+import hashlib
+import hmac
+import logging
+import logging.handlers
+import queue
 import time
 import sqlite3
+import threading
 import json
+from collections import OrderedDict
 import re
-import urllib.request
-import urllib.error
+from dataclasses import dataclass
+import httpx
+import orjson
 from dotenv import load_dotenv
 from google.adk import Agent  # Google Agent Development Kit
 from google.adk.tools.mcp_tool import McpToolset  # Multi-Channel Platform Toolset
@@ -22,7 +32,7 @@ from google.adk.runners import Runner  # ใช้สำหรับรัน Ag
 from google.adk.sessions import InMemorySessionService  # จัดการ session ของ Agent
 from google.genai.types import Content, Part  # สำหรับสร้าง content ให้ Agent
 from pydantic import BaseModel  # สำหรับสร้าง data model
-from typing import List, Dict, Any, Optional  # type hints
+from typing import List, Dict, Any, Optional, Set, Tuple  # type hints
 from mcp.shared.exceptions import McpError  # จัดการ error จาก MCP
 
 
@@ -30,6 +40,23 @@ from mcp.shared.exceptions import McpError  # จัดการ error จาก
 load_dotenv()
 
 
+# ตั้งค่า logger ของแอปพลิเคชัน (ระดับกำหนดได้ผ่าน LOG_LEVEL, ค่าเริ่มต้น INFO)
+# log จะถูกส่งเข้าคิวแล้วให้ QueueListener เขียนออก stderr ในเธรดแยก เพื่อไม่ให้ I/O อยู่บนเส้นทางของคำขอ
+logger = logging.getLogger("linebot")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+_LOG_LISTENER: Optional[logging.handlers.QueueListener] = None
+if not logger.handlers:
+    _log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    _LOG_LISTENER = logging.handlers.QueueListener(_log_queue, _log_handler)
+    _LOG_LISTENER.start()
+    # หยุด listener ตอนปิดโปรเซส (ไม่ใช่ตอน shutdown ของแอป) เพื่อให้ log ที่เกิดหลัง shutdown ยังถูกเขียนออก
+    atexit.register(_LOG_LISTENER.stop)
+    logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+    logger.propagate = False
+
+
 # สร้าง FastAPI application
 app = FastAPI(title="LINE Bot with Google Generative AI")
 
@@ -37,6 +64,7 @@ app = FastAPI(title="LINE Bot with Google Generative AI")
 # ตัวแปรสำหรับการเชื่อมต่อกับ LINE API
 LINE_CHANNEL_ACCESS_TOKEN = (os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))  # Token สำหรับเข้าถึง LINE API
 LINE_CHANNEL_SECRET = (os.getenv("LINE_CHANNEL_SECRET"))  # Secret key สำหรับตรวจสอบความถูกต้องของ webhook
+_LINE_SECRET_BYTES = (LINE_CHANNEL_SECRET or "").encode("utf-8")  # คีย์ HMAC สำหรับตรวจสอบลายเซ็น (encode ครั้งเดียว)
 DESTINATION_USER_ID = (os.getenv("DESTINATION_USER_ID"))  # User ID ปลายทางสำหรับส่งข้อความ
 GOOGLE_API_KEY = (os.getenv("GOOGLE_API_KEY"))  # API Key สำหรับเข้าถึง Google Generative AI
 
@@ -44,6 +72,16 @@ GOOGLE_API_KEY = (os.getenv("GOOGLE_API_KEY"))  # API Key สำหรับเ
 APP_NAME = "mcp-line-bot"  # ชื่อแอปพลิเคชันสำหรับ MCP
 
 
+# endpoint และ header สำหรับเรียก LINE Messaging API (สร้างครั้งเดียวตอน import)
+LINE_PUSH_URL = "https://api.line.me/v2/bot/message/push"
+LINE_REPLY_URL = "https://api.line.me/v2/bot/message/reply"
+LINE_BOT_INFO_URL = "https://api.line.me/v2/bot/info"
+_AUTH_HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}",
+}
+
+
 def create_campaign_agent():
     """
     สร้าง Campaign Agent และ Runner สำหรับการทำงานกับ LINE Bot
@@ -55,11 +93,11 @@ def create_campaign_agent():
         Runner: Runner object ที่ใช้สำหรับรัน Agent
         
     Raises:
-        RuntimeError: เมื่อไม่มีการตั้งค่า LINE_CHANNEL_ACCESS_TOKEN, DESTINATION_USER_ID หรือ GOOGLE_API_KEY
+        RuntimeError: เมื่อไม่มีการตั้งค่า LINE_CHANNEL_ACCESS_TOKEN หรือ GOOGLE_API_KEY
     """
 
-    if not LINE_CHANNEL_ACCESS_TOKEN or not DESTINATION_USER_ID:
-        raise RuntimeError("Missing LINE_CHANNEL_ACCESS_TOKEN or DESTINATION_USER_ID for MCP server")
+    if not LINE_CHANNEL_ACCESS_TOKEN:
+        raise RuntimeError("Missing LINE_CHANNEL_ACCESS_TOKEN for MCP server")
 
     if not GOOGLE_API_KEY:
         raise RuntimeError("Missing GOOGLE_API_KEY for Google Generative AI")
@@ -160,67 +198,272 @@ class LineWebhookRequest(BaseModel):
     events: List[LineEvent]
 
 
+@dataclass
+class IncomingEvent:
+    """
+    ข้อมูลของเหตุการณ์ข้อความที่ผ่านการตรวจสอบแล้ว สร้างครั้งเดียวใน /webhook และส่งต่อให้ agent
+    
+    Attributes:
+        user_id: ID ของผู้ใช้
+        text: ข้อความที่ผู้ใช้ส่งมา
+        reply_token: Token สำหรับตอบกลับข้อความ
+        ask_flex: ผู้ใช้ต้องการ Flex Message หรือไม่ (ตรวจจากคำสำคัญในข้อความ)
+        received_at: เวลาที่ได้รับเหตุการณ์จาก time.monotonic() ใช้ตรวจอายุของ reply token
+    """
+    user_id: str
+    text: str
+    reply_token: str
+    ask_flex: bool
+    received_at: float
+
+
+# อายุของ reply token ที่ยังถือว่าใช้ได้ (LINE กำหนดไว้ประมาณ 1 นาที เผื่อเวลาไว้เล็กน้อย)
+REPLY_TOKEN_TTL_SECONDS = 50
+
 
+def _usable_reply_token(ev: IncomingEvent) -> Optional[str]:
+    """
+    คืน reply token ของเหตุการณ์ถ้ายังไม่หมดอายุ
+    
+    Args:
+        ev: เหตุการณ์ข้อความ
+        
+    Returns:
+        Optional[str]: reply token หรือ None ถ้าหมดอายุแล้ว (ให้ส่งแบบ push แทน)
+    """
+    if ev.reply_token and (time.monotonic() - ev.received_at) < REPLY_TOKEN_TTL_SECONDS:
+        return ev.reply_token
+    return None
 
 
-RUNNER = None  # ตัวแปรสำหรับเก็บ Runner ของ Agent
+
+
+
+RUNNER = None  # ตัวแปรสำหรับเก็บ Runner ของ Agent (สร้างใน startup_event)
+
+# เซสชันที่ยืนยันแล้วว่ามีอยู่ใน session service ในรูปแบบ (app_name, user_id, session_id)
+# เรียงตามการใช้งานล่าสุด (เก่าไปใหม่) เพื่อลบเซสชันที่ไม่ได้ใช้งานนานที่สุดเมื่อเกินจำนวนสูงสุด
+SESSION_CACHE_MAX_ENTRIES = 10000
+_KNOWN_SESSIONS: "OrderedDict[Tuple[str, str, str], None]" = OrderedDict()
 
 
 # ค่าคงที่สำหรับการป้องกันการประมวลผลข้อความซ้ำ
 DEDUP_TTL_SECONDS = 300  # 5 minutes
-DEDUP_CACHE: Dict[str, float] = {}  # แคชสำหรับเก็บข้อมูลการป้องกันการประมวลผลซ้ำ
+DEDUP_MAX_ENTRIES = 10000  # จำนวนคีย์สูงสุดในแคช (เกินแล้วลบคีย์ที่เก่าที่สุดออก)
+# แคชสำหรับเก็บข้อมูลการป้องกันการประมวลผลซ้ำ เรียงตามเวลาที่บันทึก (เก่าไปใหม่)
+DEDUP_CACHE: "OrderedDict[str, float]" = OrderedDict()
+# เปิดใช้ฐานข้อมูล SQLite เป็นตัวสำรองสำหรับการป้องกันการประมวลผลซ้ำข้ามโปรเซส
+# (ตั้ง DEDUP_PERSISTENT=1 ใน environment เพื่อเปิดใช้ ค่าเริ่มต้นคือปิด)
+DEDUP_PERSISTENT = os.getenv("DEDUP_PERSISTENT", "0").lower() in ("1", "true", "yes")
 
 
 # พาธของไฟล์ฐานข้อมูล SQLite สำหรับเก็บข้อมูลการป้องกันการประมวลผลซ้ำ
 DEDUP_DB_PATH = os.path.join(os.path.dirname(__file__), "dedup_cache.sqlite3")
+# ลบคีย์ที่หมดอายุออกจากฐานข้อมูลทุกๆ N ครั้งที่เรียกใช้ _dedup_seen_db
+DEDUP_SWEEP_EVERY = 256
+_DEDUP_DB_CALLS = 0
 
 
 # พาธของไฟล์ฐานข้อมูล SQLite สำหรับเก็บประวัติการสนทนา
 MEMORY_DB_PATH = os.path.join(os.path.dirname(__file__), "memory.sqlite3")
 
+# ล็อกสำหรับการเข้าถึงฐานข้อมูล เนื่องจากการเชื่อมต่อ SQLite ถูกใช้ร่วมกันระหว่างหลายเธรด
+_DB_LOCK = threading.Lock()
+
+def _open_db(path: str) -> sqlite3.Connection:
+    """
+    เปิดการเชื่อมต่อ SQLite ที่ใช้ร่วมกันตลอดอายุของโปรเซส
+    
+    ตั้งค่า WAL และ PRAGMA ต่างๆ เพียงครั้งเดียว แทนการเปิดการเชื่อมต่อใหม่ทุกครั้งที่เรียกใช้
+    
+    Args:
+        path: พาธของไฟล์ฐานข้อมูล
+        
+    Returns:
+        sqlite3.Connection: การเชื่อมต่อแบบ autocommit ที่ใช้ข้ามเธรดได้
+    """
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=30000000000")
+    return conn
+
+
+# การเชื่อมต่อฐานข้อมูลที่ใช้ร่วมกัน (เปิดครั้งเดียวตอน import)
+_MEMORY_DB = _open_db(MEMORY_DB_PATH)
+_DEDUP_DB = _open_db(DEDUP_DB_PATH) if DEDUP_PERSISTENT else None
+
 def _memory_init():
     """
     สร้างตารางฐานข้อมูลสำหรับเก็บประวัติการสนทนา
     
-    ฟังก์ชันนี้จะสร้างตาราง memory และดัชนีสำหรับการค้นหาข้อมูลอย่างมีประสิทธิภาพ
+    ฟังก์ชันนี้จะสร้างตาราง memory แบบ WITHOUT ROWID ที่มี primary key เป็น (user_id, ts)
+    และย้ายข้อมูลจากตารางรูปแบบเดิมถ้ามี พร้อมโหลดรายชื่อผู้ใช้ที่มีประวัติอยู่แล้ว
     """
+    global _KNOWN_USERS
     try:
-        conn = sqlite3.connect(MEMORY_DB_PATH)
-        with conn:
-            conn.execute(
+        with _DB_LOCK:
+            row = _MEMORY_DB.execute(
+                "SELECT sql FROM sqlite_master WHERE type='table' AND name='memory'"
+            ).fetchone()
+            legacy = row is not None and "WITHOUT ROWID" not in (row[0] or "").upper()
+            _MEMORY_DB.execute("BEGIN")
+            if legacy:
+                # ตารางรูปแบบเดิม (มี ROWID) ให้ย้ายข้อมูลไปยังตารางใหม่
+                _MEMORY_DB.execute("ALTER TABLE memory RENAME TO memory_legacy")
+            # จัดเก็บแบบ clustered ตาม (user_id, ts) ทำให้ดึงข้อความล่าสุดของผู้ใช้ได้โดยไม่ต้องมีดัชนีแยก
+            _MEMORY_DB.execute(
                 """
                 CREATE TABLE IF NOT EXISTS memory (
-                    user_id TEXT,
+                    user_id TEXT NOT NULL,
+                    ts      REAL NOT NULL,
                     role    TEXT,
                     text    TEXT,
-                    ts      REAL
-                )
+                    PRIMARY KEY (user_id, ts)
+                ) WITHOUT ROWID
                 """
             )
-            conn.execute(
-                "CREATE INDEX IF NOT EXISTS idx_memory_user_ts ON memory(user_id, ts)"
-            )
+            dropped = 0
+            if legacy:
+                # แถวที่ซ้ำ (user_id, ts) กันไม่สามารถเก็บในตารางใหม่ได้ ให้นับไว้และรายงาน
+                legacy_rows = _MEMORY_DB.execute("SELECT COUNT(*) FROM memory_legacy").fetchone()[0]
+                # ตัดข้อความยาวเหมือนกับที่ memory_add_message ทำ เพราะบริบทไม่ได้ตัดซ้ำตอนแสดงผล
+                migrated = _MEMORY_DB.execute(
+                    "INSERT OR IGNORE INTO memory(user_id, ts, role, text) "
+                    "SELECT user_id, ts, role, "
+                    "CASE WHEN length(text) > ?1 THEN substr(text, 1, ?1) || '...' ELSE text END "
+                    "FROM memory_legacy",
+                    (MEMORY_TEXT_MAX_CHARS,),
+                ).rowcount
+                dropped = legacy_rows - migrated
+                _MEMORY_DB.execute("DROP TABLE memory_legacy")
+            _MEMORY_DB.execute("COMMIT")
+            if dropped:
+                logger.warning("[MEMORY][WARN] migration dropped %d rows with duplicate (user_id, ts)", dropped)
+            known = {row[0] for row in _MEMORY_DB.execute("SELECT DISTINCT user_id FROM memory")}
+        _KNOWN_USERS = known
+    except Exception as e:
+        if _MEMORY_DB.in_transaction:
+            _MEMORY_DB.execute("ROLLBACK")
+        logger.warning("[MEMORY][WARN] init failed: %s", e)
+
+def _dedup_init():
+    """
+    สร้างตารางฐานข้อมูลสำหรับเก็บคีย์การป้องกันการประมวลผลซ้ำ
+    """
+    try:
+        with _DB_LOCK:
+            _DEDUP_DB.execute("CREATE TABLE IF NOT EXISTS dedup (key TEXT PRIMARY KEY, ts REAL)")
+            # ดัชนีสำหรับการลบข้อมูลที่หมดอายุเป็นระยะ
+            _DEDUP_DB.execute("CREATE INDEX IF NOT EXISTS idx_dedup_ts ON dedup(ts)")
     except Exception as e:
-        print(f"[MEMORY][WARN] init failed: {e}")
+        logger.warning("[DEDUP][WARN] init failed: %s", e)
+
+# คิวของข้อความที่รอเขียนลงฐานข้อมูลแบบกลุ่ม ในรูปแบบ (user_id, ts, role, text)
+_MEMORY_QUEUE: "asyncio.Queue[tuple]" = asyncio.Queue()
+MEMORY_FLUSH_INTERVAL_SECONDS = 0.05  # รอรวบรวมข้อความก่อนเขียนแต่ละรอบ
+MEMORY_FLUSH_BATCH_SIZE = 32  # จำนวนข้อความสูงสุดที่เขียนต่อหนึ่งรอบ
+MEMORY_TEXT_MAX_CHARS = 300  # ความยาวข้อความสูงสุดที่เก็บต่อหนึ่งข้อความ
+# ts ล่าสุดที่ใส่ลงคิวของผู้ใช้แต่ละคน ใช้เลื่อน ts ให้ไม่ซ้ำกับ primary key (user_id, ts)
+_LAST_MEMORY_TS: Dict[str, float] = {}
+
+# แคชของข้อความบริบทที่สร้างแล้ว {user_id: (limit, context)} ถูกล้างเมื่อผู้ใช้มีข้อความใหม่
+CTX_CACHE_MAX_ENTRIES = 1024
+_CTX_CACHE: "OrderedDict[str, Tuple[int, Optional[str]]]" = OrderedDict()
+_CTX_LOCK = threading.Lock()  # แคชถูกใช้ทั้งจาก event loop และจากเธรดของ asyncio.to_thread
+
+# ผู้ใช้ที่มีประวัติการสนทนาอยู่แล้ว (โหลดตอน _memory_init) ใช้ข้ามการ query สำหรับผู้ใช้ใหม่
+# ถ้าเป็น None แสดงว่าโหลดไม่สำเร็จ และจะ query ทุกครั้งตามปกติ
+_KNOWN_USERS: Optional[Set[str]] = None
 
 def memory_add_message(user_id: str, role: str, text: str) -> None:
     """
     เพิ่มข้อความใหม่ลงในประวัติการสนทนา
     
+    ข้อความจะถูกตัดให้ไม่เกิน MEMORY_TEXT_MAX_CHARS ตัวอักษร แล้วใส่ลงคิว
+    เพื่อให้ _memory_flusher เขียนลงฐานข้อมูลเป็นกลุ่ม ฟังก์ชันนี้ไม่โยน exception
+    (ข้อผิดพลาดจากฐานข้อมูลจะถูกบันทึกใน log โดย _memory_write_batch)
+    
     Args:
         user_id: ID ของผู้ใช้
         role: บทบาทของผู้ส่งข้อความ (user หรือ bot)
         text: เนื้อหาข้อความ
     """
+    text = str(text or "").strip()
+    if len(text) > MEMORY_TEXT_MAX_CHARS:
+        text = text[:MEMORY_TEXT_MAX_CHARS] + "..."
+    with _CTX_LOCK:
+        _CTX_CACHE.pop(user_id, None)
+    if _KNOWN_USERS is not None:
+        _KNOWN_USERS.add(user_id)
+    # ข้อความที่เกิดในเวลาเดียวกัน (ความละเอียดของ time.time()) จะถูกเลื่อน ts เล็กน้อยเพื่อไม่ให้ชน primary key
+    ts = time.time()
+    last_ts = _LAST_MEMORY_TS.get(user_id)
+    if last_ts is not None and ts <= last_ts:
+        ts = last_ts + 1e-6
+    _LAST_MEMORY_TS[user_id] = ts
+    _MEMORY_QUEUE.put_nowait((user_id, ts, role, text))
+
+def _memory_write_batch(items: List[tuple]) -> None:
+    """
+    เขียนข้อความหลายรายการลงฐานข้อมูลภายในทรานแซกชันเดียว
+    
+    Args:
+        items: รายการ (user_id, ts, role, text)
+    """
+    sql = "INSERT INTO memory(user_id, ts, role, text) VALUES(?, ?, ?, ?)"
     try:
-        conn = sqlite3.connect(MEMORY_DB_PATH)
-        with conn:
-            conn.execute(
-                "INSERT INTO memory(user_id, role, text, ts) VALUES(?, ?, ?, ?)",
-                (user_id, role, text or "", time.time()),
-            )
+        with _DB_LOCK:
+            _MEMORY_DB.execute("BEGIN")
+            try:
+                _MEMORY_DB.executemany(sql, items)
+                _MEMORY_DB.execute("COMMIT")
+            except sqlite3.IntegrityError:
+                _MEMORY_DB.execute("ROLLBACK")
+                # มีแถวที่ชน primary key ให้เขียนทีละแถว เพื่อไม่ให้แถวอื่นในกลุ่มหายไปด้วย
+                for item in items:
+                    try:
+                        _MEMORY_DB.execute(sql, item)
+                    except sqlite3.IntegrityError as e:
+                        logger.warning("[MEMORY][WARN] add failed user=%s ts=%s: %s", item[0], item[1], e)
+            except Exception:
+                _MEMORY_DB.execute("ROLLBACK")
+                raise
+        # ล้างแคชบริบทอีกครั้งหลังเขียนจริง เผื่อมีการสร้างบริบทระหว่างที่ข้อความยังอยู่ในคิว
+        with _CTX_LOCK:
+            for user_id, *_ in items:
+                _CTX_CACHE.pop(user_id, None)
     except Exception as e:
-        print(f"[MEMORY][WARN] add failed: {e}")
+        logger.warning("[MEMORY][WARN] add failed (%d rows): %s", len(items), e)
+
+def _memory_drain() -> None:
+    """
+    เขียนข้อความที่ค้างอยู่ในคิวทั้งหมดลงฐานข้อมูล (ใช้ตอนปิดแอปพลิเคชัน)
+    """
+    while not _MEMORY_QUEUE.empty():
+        items = []
+        while not _MEMORY_QUEUE.empty() and len(items) < MEMORY_FLUSH_BATCH_SIZE:
+            items.append(_MEMORY_QUEUE.get_nowait())
+        _memory_write_batch(items)
+
+async def _memory_flusher() -> None:
+    """
+    งานเบื้องหลังที่ดึงข้อความจากคิวและเขียนลงฐานข้อมูลเป็นกลุ่ม
+    
+    รอข้อความแรก แล้วรวบรวมข้อความเพิ่มเติมภายใน MEMORY_FLUSH_INTERVAL_SECONDS
+    (ไม่เกิน MEMORY_FLUSH_BATCH_SIZE รายการ) เพื่อเขียนในทรานแซกชันเดียว
+    """
+    while True:
+        items = [await _MEMORY_QUEUE.get()]
+        try:
+            await asyncio.sleep(MEMORY_FLUSH_INTERVAL_SECONDS)
+        finally:
+            while not _MEMORY_QUEUE.empty() and len(items) < MEMORY_FLUSH_BATCH_SIZE:
+                items.append(_MEMORY_QUEUE.get_nowait())
+            # เขียนในเธรดแยก เพื่อไม่ให้ event loop ต้องรอ SQLite
+            await asyncio.to_thread(_memory_write_batch, items)
 
 def memory_get_recent(user_id: str, limit: int = 8):
     """
@@ -234,21 +477,45 @@ def memory_get_recent(user_id: str, limit: int = 8):
         list: รายการข้อความล่าสุด เรียงตามเวลา (เก่าไปใหม่)
     """
     try:
-        conn = sqlite3.connect(MEMORY_DB_PATH)
-        with conn:
-            rows = conn.execute(
-                "SELECT role, text FROM memory WHERE user_id=? ORDER BY ts DESC LIMIT ?",
+        with _DB_LOCK:
+            rows = _MEMORY_DB.execute(
+                "SELECT role, text FROM ("
+                "SELECT role, text, ts FROM memory WHERE user_id=? ORDER BY ts DESC LIMIT ?"
+                ") ORDER BY ts ASC",
                 (user_id, limit),
             ).fetchall()
         
-        return list(reversed(rows))
+        return rows
     except Exception as e:
-        print(f"[MEMORY][WARN] get failed: {e}")
+        logger.warning("[MEMORY][WARN] get failed: %s", e)
         return []
 
-def build_memory_context(user_id: str, limit: int = 8) -> Optional[str]:
+def _cached_memory_context(user_id: str, limit: int = 8) -> Tuple[bool, Optional[str]]:
     """
-    สร้างข้อความบริบทจากประวัติการสนทนา
+    หาบริบทการสนทนาโดยไม่ต้อง query ฐานข้อมูล (ใช้แค่ set/dict จึงเรียกบน event loop ได้)
+    
+    Args:
+        user_id: ID ของผู้ใช้
+        limit: จำนวนข้อความสูงสุดที่ต้องการใช้
+        
+    Returns:
+        Tuple[bool, Optional[str]]: (พบคำตอบหรือไม่, ข้อความบริบท) ถ้าไม่พบต้องเรียก _load_memory_context
+    """
+    # ผู้ใช้ที่ยังไม่เคยมีประวัติ ไม่ต้อง query ฐานข้อมูล
+    if _KNOWN_USERS is not None and user_id not in _KNOWN_USERS:
+        return True, None
+
+    with _CTX_LOCK:
+        cached = _CTX_CACHE.get(user_id)
+        if cached is not None and cached[0] == limit:
+            _CTX_CACHE.move_to_end(user_id)
+            return True, cached[1]
+    return False, None
+
+
+def _load_memory_context(user_id: str, limit: int = 8) -> Optional[str]:
+    """
+    อ่านประวัติจากฐานข้อมูล สร้างข้อความบริบท และเก็บลงแคช (มี I/O ควรเรียกผ่าน asyncio.to_thread)
     
     Args:
         user_id: ID ของผู้ใช้
@@ -258,23 +525,42 @@ def build_memory_context(user_id: str, limit: int = 8) -> Optional[str]:
         str หรือ None: ข้อความบริบทที่สร้างขึ้น หรือ None ถ้าไม่มีข้อมูล
     """
     rows = memory_get_recent(user_id, limit=limit)
-    if not rows:
-        return None
     lines = []
     for role, text in rows:
         if not text:
             continue
         prefix = "ผู้ใช้" if (role or "").lower() == "user" else "บอท"
-        t = str(text).strip()
-        if len(t) > 300:
-            t = t[:300] + "..."
-        lines.append(f"{prefix}: {t}")
-    if not lines:
-        return None
-    return "บริบทก่อนหน้า (สรุปย่อ):\n" + "\n".join(lines)
+        lines.append(f"{prefix}: {text}")
+    ctx = ("บริบทก่อนหน้า (สรุปย่อ):\n" + "\n".join(lines)) if lines else None
+
+    with _CTX_LOCK:
+        _CTX_CACHE[user_id] = (limit, ctx)
+        _CTX_CACHE.move_to_end(user_id)
+        if len(_CTX_CACHE) > CTX_CACHE_MAX_ENTRIES:
+            _CTX_CACHE.popitem(last=False)
+    return ctx
+
+
+def build_memory_context(user_id: str, limit: int = 8) -> Optional[str]:
+    """
+    สร้างข้อความบริบทจากประวัติการสนทนา
+    
+    Args:
+        user_id: ID ของผู้ใช้
+        limit: จำนวนข้อความสูงสุดที่ต้องการใช้
+        
+    Returns:
+        str หรือ None: ข้อความบริบทที่สร้างขึ้น หรือ None ถ้าไม่มีข้อมูล
+    """
+    found, ctx = _cached_memory_context(user_id, limit)
+    if found:
+        return ctx
+    return _load_memory_context(user_id, limit)
 
 
 _memory_init()
+if DEDUP_PERSISTENT:
+    _dedup_init()
 
 
 # ระยะเวลาในการจำกัดการใช้งานของผู้ใช้ (วินาที)
@@ -311,12 +597,25 @@ def _user_throttled(user_id: str) -> bool:
     return False
 
 
+def _text_digest(text: str) -> str:
+    """
+    สร้าง digest ขนาด 64 บิตของข้อความ ที่ให้ค่าเดิมเสมอไม่ว่าจะรันในโปรเซสใด
+    
+    Args:
+        text: ข้อความที่ต้องการสร้าง digest
+        
+    Returns:
+        str: digest ในรูปแบบเลขฐานสิบหก
+    """
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
 def _dedup_seen(key: str) -> bool:
     """
     ตรวจสอบว่าข้อมูลซ้ำหรือไม่ (deduplication)
     
     ฟังก์ชันนี้จะตรวจสอบว่า key ที่ระบุเคยถูกบันทึกไว้ในแคชหรือไม่
-    และทำการลบ key ที่หมดอายุออกจากแคช
+    เนื่องจากคีย์ในแคชเรียงตามเวลาที่บันทึก จึงลบคีย์ที่หมดอายุได้จากด้านหน้าของแคชโดยไม่ต้องวนทั้งหมด
     
     Args:
         key: คีย์ที่ใช้ในการตรวจสอบความซ้ำซ้อน
@@ -326,19 +625,20 @@ def _dedup_seen(key: str) -> bool:
     """
     now = time.time()
     
-    # ลบคีย์ที่หมดอายุออกจากแคช
-    expired = [k for k, ts in DEDUP_CACHE.items() if (now - ts) > DEDUP_TTL_SECONDS]
-    for k in expired:
-        try:
-            del DEDUP_CACHE[k]
-        except KeyError:
-            pass
+    # ลบคีย์ที่หมดอายุออกจากด้านหน้าของแคช
+    while DEDUP_CACHE:
+        oldest_ts = next(iter(DEDUP_CACHE.values()))
+        if (now - oldest_ts) <= DEDUP_TTL_SECONDS:
+            break
+        DEDUP_CACHE.popitem(last=False)
     
-    # ตรวจสอบว่าคีย์อยู่ในแคชหรือไม่
-    if key in DEDUP_CACHE and (now - DEDUP_CACHE[key]) <= DEDUP_TTL_SECONDS:
+    # คีย์ที่เหลืออยู่ในแคชยังไม่หมดอายุทั้งหมด
+    if key in DEDUP_CACHE:
         return True
     # บันทึกคีย์ลงในแคชพร้อมเวลาปัจจุบัน
     DEDUP_CACHE[key] = now
+    if len(DEDUP_CACHE) > DEDUP_MAX_ENTRIES:
+        DEDUP_CACHE.popitem(last=False)
     return False
 
 
@@ -346,8 +646,10 @@ def _dedup_seen_db(key: str) -> bool:
     """
     ตรวจสอบว่าข้อมูลซ้ำหรือไม่โดยใช้ฐานข้อมูล SQLite (deduplication with persistent storage)
     
+    ใช้เป็นตัวสำรองข้ามโปรเซสเมื่อเปิด DEDUP_PERSISTENT เท่านั้น โดยเรียกหลังจาก _dedup_seen
+    
     ฟังก์ชันนี้จะตรวจสอบว่า key ที่ระบุเคยถูกบันทึกไว้ในฐานข้อมูลหรือไม่
-    และทำการลบ key ที่หมดอายุออกจากฐานข้อมูล
+    และทำการลบ key ที่หมดอายุออกจากฐานข้อมูลเป็นระยะ (ทุก DEDUP_SWEEP_EVERY ครั้ง)
     
     Args:
         key: คีย์ที่ใช้ในการตรวจสอบความซ้ำซ้อน
@@ -355,56 +657,203 @@ def _dedup_seen_db(key: str) -> bool:
     Returns:
         bool: True ถ้าพบว่าข้อมูลซ้ำ (เคยเห็นมาก่อน), False ถ้าไม่ซ้ำ
     """
+    global _DEDUP_DB_CALLS
     try:
-        # เชื่อมต่อกับฐานข้อมูล SQLite
-        conn = sqlite3.connect(DEDUP_DB_PATH)
-        with conn:
-            # สร้างตารางถ้ายังไม่มี
-            conn.execute("CREATE TABLE IF NOT EXISTS dedup (key TEXT PRIMARY KEY, ts REAL)")
-            # ลบข้อมูลที่หมดอายุ
-            cutoff = time.time() - DEDUP_TTL_SECONDS
-            conn.execute("DELETE FROM dedup WHERE ts < ?", (cutoff,))
-            try:
-                # พยายามเพิ่มข้อมูลใหม่
-                conn.execute("INSERT INTO dedup(key, ts) VALUES(?, ?)", (key, time.time()))
-                # ถ้าเพิ่มสำเร็จ แสดงว่าไม่มีข้อมูลซ้ำ
-                return False
-            except sqlite3.IntegrityError:
-                # เกิด IntegrityError เนื่องจากมี key ซ้ำ
-                # ตรวจสอบเวลาของข้อมูลที่มีอยู่
-                row = conn.execute("SELECT ts FROM dedup WHERE key=?", (key,)).fetchone()
-                if row is None:
-                    # ไม่พบข้อมูล (อาจถูกลบไปแล้ว) ให้เพิ่มใหม่
-                    conn.execute("REPLACE INTO dedup(key, ts) VALUES(?, ?)", (key, time.time()))
-                    return False
-                if (time.time() - float(row[0])) <= DEDUP_TTL_SECONDS:
-                    # ข้อมูลยังไม่หมดอายุ ถือว่าซ้ำ
-                    return True
-                
-                # ข้อมูลหมดอายุแล้ว อัปเดตเวลาและถือว่าไม่ซ้ำ
-                conn.execute("REPLACE INTO dedup(key, ts) VALUES(?, ?)", (key, time.time()))
+        now = time.time()
+        with _DB_LOCK:
+            conn = _DEDUP_DB
+            # ลบข้อมูลที่หมดอายุเป็นระยะ แทนการลบทุกครั้งที่เรียกใช้
+            _DEDUP_DB_CALLS += 1
+            if _DEDUP_DB_CALLS % DEDUP_SWEEP_EVERY == 0:
+                conn.execute("DELETE FROM dedup WHERE ts < ?", (now - DEDUP_TTL_SECONDS,))
+            # พยายามเพิ่มข้อมูลใหม่ ถ้าเพิ่มสำเร็จ แสดงว่าไม่มีข้อมูลซ้ำ
+            cur = conn.execute("INSERT OR IGNORE INTO dedup(key, ts) VALUES(?, ?)", (key, now))
+            if cur.rowcount == 1:
                 return False
+            # มี key อยู่แล้ว ตรวจสอบเวลาของข้อมูลที่มีอยู่
+            row = conn.execute("SELECT ts FROM dedup WHERE key=?", (key,)).fetchone()
+            if row is not None and (now - float(row[0])) <= DEDUP_TTL_SECONDS:
+                # ข้อมูลยังไม่หมดอายุ ถือว่าซ้ำ
+                return True
+            # ข้อมูลหมดอายุแล้ว (แต่ยังไม่ถูกลบ) อัปเดตเวลาและถือว่าไม่ซ้ำ
+            conn.execute("REPLACE INTO dedup(key, ts) VALUES(?, ?)", (key, now))
+            return False
     except Exception as e:
-        # กรณีเกิดข้อผิดพลาดในการใช้ฐานข้อมูล ให้ใช้แคชในหน่วยความจำแทน
-        print(f"[DEDUP][WARN] persistent DB failed: {e}")
-        return _dedup_seen(key)
+        # กรณีเกิดข้อผิดพลาดในการใช้ฐานข้อมูล ให้ถือผลจากแคชในหน่วยความจำ (ที่ผู้เรียกตรวจสอบไปแล้ว)
+        logger.warning("[DEDUP][WARN] persistent DB failed: %s", e)
+        return False
+
+# HTTP client สำหรับเรียก LINE Messaging API ใช้ร่วมกันทั้งโปรเซสเพื่อคงการเชื่อมต่อ (keep-alive / HTTP/2) ไว้
+# transport ลองเชื่อมต่อใหม่เมื่อเชื่อมต่อไม่สำเร็จ (ไม่ retry ตาม HTTP status เพราะการ push ซ้ำจะทำให้ผู้ใช้ได้ข้อความซ้ำ)
+_LINE_CLIENT = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    ),
+    timeout=10.0,
+    headers=_AUTH_HEADERS,
+)
+# งานเบื้องหลังสำหรับเขียนประวัติการสนทนาลงฐานข้อมูล
+_MEMORY_FLUSHER_TASK: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def startup_event():
+    """
+    เตรียมทรัพยากรที่ใช้ร่วมกันเมื่อเริ่มต้นแอปพลิเคชัน
+    """
+    global RUNNER, _MEMORY_FLUSHER_TASK
+    if not LINE_CHANNEL_SECRET:
+        raise RuntimeError("Missing LINE_CHANNEL_SECRET for webhook signature verification")
+    # สร้าง Runner ครั้งเดียวตอนเริ่มต้น เพื่อไม่ให้คำขอแรกๆ ที่มาพร้อมกันสร้าง MCP server ซ้ำ
+    RUNNER = create_campaign_agent()
+    _MEMORY_FLUSHER_TASK = asyncio.create_task(_memory_flusher())
+    # เปิดการเชื่อมต่อ TLS/HTTP2 ไปยัง api.line.me ไว้ล่วงหน้า เพื่อไม่ให้ข้อความแรกต้องรอ handshake
+    try:
+        r = await _LINE_CLIENT.get(LINE_BOT_INFO_URL)
+        logger.info("[STARTUP] LINE connection warmed: HTTP %s", r.status_code)
+    except Exception as e:
+        logger.warning("[STARTUP][WARN] LINE connection warm-up failed: %s", e)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    ปิดทรัพยากรที่ใช้ร่วมกันเมื่อปิดแอปพลิเคชัน
+    """
+    if _MEMORY_FLUSHER_TASK is not None:
+        _MEMORY_FLUSHER_TASK.cancel()
+        await asyncio.gather(_MEMORY_FLUSHER_TASK, return_exceptions=True)
+    # เขียนข้อความที่ยังค้างอยู่ในคิวก่อนปิด
+    _memory_drain()
+    await _LINE_CLIENT.aclose()
+
 
-def get_runner():
+# จำนวนงานประมวลผลด้วย agent ที่ทำงานพร้อมกันได้สูงสุด
+AGENT_MAX_CONCURRENCY = 64
+# เวลาสูงสุดที่รอผลลัพธ์จาก agent stream (วินาที)
+AGENT_STREAM_TIMEOUT_SECONDS = 20
+_AGENT_SEMAPHORE = asyncio.Semaphore(AGENT_MAX_CONCURRENCY)
+# เก็บอ้างอิงของงานเบื้องหลังไว้จนกว่าจะเสร็จ เพื่อไม่ให้ถูก garbage collect ระหว่างทำงาน
+_PENDING_TASKS: set = set()
+
+
+async def _run_agent_bounded(runner, ev: IncomingEvent):
+    """
+    เรียก process_with_adk_agent โดยจำกัดจำนวนงานที่ทำงานพร้อมกันด้วย semaphore
+    
+    Args:
+        runner: ออบเจ็กต์ Runner ที่ใช้ในการประมวลผล
+        ev: เหตุการณ์ข้อความที่จะประมวลผล
+    """
+    async with _AGENT_SEMAPHORE:
+        try:
+            await process_with_adk_agent(runner, ev)
+        except Exception as e:
+            logger.exception("[ERROR] ADK processing failed: %s", e)
+
+
+def _verify_signature(body: bytes, signature: str) -> bool:
     """
-    สร้างหรือเรียกใช้ Runner ที่มีอยู่แล้ว
+    ตรวจสอบลายเซ็น X-Line-Signature ของคำขอ webhook
     
-    ฟังก์ชันนี้จะตรวจสอบว่ามี Runner อยู่แล้วหรือไม่ ถ้าไม่มีจะสร้างใหม่
-    เพื่อให้ใช้ Runner เดียวกันตลอดอายุของโปรเซส
+    LINE คำนวณลายเซ็นจาก HMAC-SHA256 ของ body ดิบ โดยใช้ channel secret เป็นคีย์ แล้วเข้ารหัสเป็น base64
     
+    Args:
+        body: body ดิบของคำขอ
+        signature: ค่าจาก header X-Line-Signature
+        
     Returns:
-        object: Runner สำหรับใช้งาน
+        bool: True ถ้าลายเซ็นถูกต้อง, False ถ้าไม่ถูกต้องหรือไม่มีลายเซ็น
     """
-    global RUNNER
-    if RUNNER is None:
-        RUNNER = create_campaign_agent()
-    return RUNNER
+    if not _LINE_SECRET_BYTES or not signature:
+        return False
+    # คำนวณและเปรียบเทียบในรูป bytes ทั้งหมด ไม่ต้อง decode body หรือ digest เป็นสตริง
+    expected = base64.b64encode(hmac.digest(_LINE_SECRET_BYTES, body, "sha256"))
+    return hmac.compare_digest(expected, signature.encode("latin-1"))
 
 
+def _source_user_id(source: Dict[str, Any], event_key: Optional[str]) -> str:
+    """
+    หาคีย์ผู้ใช้สำหรับ session และบริบทจากแหล่งที่มาของเหตุการณ์
+    
+    ใช้ userId ก่อน ถ้าไม่มีจะใช้ groupId หรือ roomId และถ้าไม่มีเลยจะสร้างคีย์ anonymous
+    ต่อข้อความ เพื่อไม่ให้ผู้ใช้ที่ไม่ระบุตัวตนทุกคนใช้ session และบริบทร่วมกัน
+    
+    Args:
+        source: ข้อมูลแหล่งที่มาของเหตุการณ์จาก webhook
+        event_key: message id หรือ webhookEventId ของเหตุการณ์
+        
+    Returns:
+        str: คีย์ผู้ใช้ที่ใช้กับ session, memory และการส่งข้อความ
+    """
+    return (
+        source.get("userId")
+        or source.get("groupId")
+        or source.get("roomId")
+        or f"anon-{source.get('type') or 'unknown'}-{event_key or time.monotonic_ns()}"
+    )
+
+
+async def _on_text(ev: Dict[str, Any]) -> bool:
+    """
+    จัดการเหตุการณ์ข้อความประเภท text จาก webhook
+    
+    ตรวจสอบความซ้ำซ้อนและการจำกัดการใช้งาน แล้วส่งข้อความไปประมวลผลด้วย ADK agent เบื้องหลัง
+    
+    Args:
+        ev: เหตุการณ์จาก webhook ในรูปแบบ dict
+        
+    Returns:
+        bool: True หากรับเหตุการณ์ไปประมวลผล, False หากข้าม
+    """
+    msg = ev.get("message") or {}
+    # ดึงข้อมูลที่จำเป็น
+    text = msg.get("text") or ""
+    msg_id = msg.get("id")
+    evt_id = ev.get("webhookEventId")
+    user_id = _source_user_id(ev.get("source") or {}, msg_id or evt_id)
+    # สร้างคีย์สำหรับตรวจสอบความซ้ำซ้อน (ใช้ digest ที่คงที่ข้ามโปรเซส แทน hash() ที่สุ่ม seed ทุกครั้งที่เริ่มโปรเซส)
+    dedup_key = evt_id or (f"{user_id}:{msg_id}" if msg_id else f"{user_id}:{_text_digest(text)}")
+
+    if _dedup_seen(dedup_key) or (
+        DEDUP_PERSISTENT and await asyncio.to_thread(_dedup_seen_db, dedup_key)
+    ):
+        logger.info("[DEDUP] Skip duplicate event: %s", dedup_key)
+        return False
+
+    # ตรวจสอบการจำกัดการใช้งานของผู้ใช้
+    if _user_throttled(user_id):
+        logger.info("[THROTTLE] Skip because user %s already processing within %ss window", user_id, RUNNING_TTL_SECONDS)
+        return False
+
+    # ดึง reply token สำหรับตอบกลับข้อความ
+    reply_token = ev.get("replyToken")
+    if not reply_token:
+        logger.warning("[WARN] No reply token for event: %s", ev.get("webhookEventId"))
+        return False
+
+    incoming = IncomingEvent(
+        user_id=user_id,
+        text=text,
+        reply_token=reply_token,
+        ask_flex=bool(FLEX_RE.search(text)),
+        received_at=time.monotonic(),
+    )
+
+    # ประมวลผลข้อความด้วย ADK agent
+    task = asyncio.create_task(_run_agent_bounded(RUNNER, incoming))
+    _PENDING_TASKS.add(task)
+    task.add_done_callback(_PENDING_TASKS.discard)
+    return True
+
+
+# ตาราง dispatch ของเหตุการณ์ webhook ตาม (ประเภทเหตุการณ์, ประเภทข้อความ)
+_HANDLERS = {
+    ("message", "text"): _on_text,
+}
+
 @app.post("/webhook")
 async def webhook(request: Request):
     """
@@ -419,9 +868,16 @@ async def webhook(request: Request):
     Returns:
         JSONResponse: การตอบกลับสถานะของการประมวลผล webhook
     """
+    raw_body = await request.body()
+
+    # ตรวจสอบลายเซ็นว่าคำขอมาจาก LINE จริง
+    if not _verify_signature(raw_body, request.headers.get("X-Line-Signature", "")):
+        logger.warning("[WEBHOOK] Invalid signature")
+        return JSONResponse({"status": "bad_request", "reason": "invalid_signature"}, status_code=400)
+
     # แปลงข้อมูลคำขอเป็น JSON
     try:
-        body = await request.json()
+        body = orjson.loads(raw_body)
     except Exception:
         return JSONResponse({"status": "bad_request", "reason": "invalid_json"}, status_code=400)
 
@@ -429,46 +885,16 @@ async def webhook(request: Request):
     events = body.get("events", []) if isinstance(body, dict) else []
     has_accepted = False
 
-    # ประมวลผลแต่ละเหตุการณ์
+    # ประมวลผลแต่ละเหตุการณ์ผ่านตาราง dispatch (ค้นหาด้วย dict ครั้งเดียวต่อเหตุการณ์)
     for ev in events:
         try:
-            # ตรวจสอบว่าเป็นเหตุการณ์ประเภทข้อความหรือไม่
-            if ev.get("type") != "message":
-                continue
-            msg = ev.get("message", {})
-            # ตรวจสอบว่าเป็นข้อความประเภทข้อความหรือไม่
-            if msg.get("type") != "text":
-                continue
-
-            # ดึงข้อมูลที่จำเป็น
-            user_id = ((ev.get("source") or {}).get("userId")) or DESTINATION_USER_ID
-            text = msg.get("text") or ""
-            msg_id = msg.get("id")
-            evt_id = ev.get("webhookEventId")
-            # สร้างคีย์สำหรับตรวจสอบความซ้ำซ้อน
-            dedup_key = evt_id or (f"{user_id}:{msg_id}" if msg_id else f"{user_id}:{hash(text)}")
-        
-            if _dedup_seen_db(dedup_key):
-                print(f"[DEDUP] Skip duplicate event: {dedup_key}")
-                continue
-
-            # ตรวจสอบการจำกัดการใช้งานของผู้ใช้
-            if _user_throttled(user_id):
-                print(f"[THROTTLE] Skip because user {user_id} already processing within {RUNNING_TTL_SECONDS}s window")
-                continue
-
-            # ดึง reply token สำหรับตอบกลับข้อความ
-            reply_token = ev.get("replyToken")
-            if not reply_token:
-                print(f"[WARN] No reply token for event: {ev.get('webhookEventId')}")
+            handler = _HANDLERS.get((ev.get("type"), (ev.get("message") or {}).get("type")))
+            if handler is None:
                 continue
-                
-            # ประมวลผลข้อความด้วย ADK agent
-            runner = get_runner()
-            asyncio.create_task(process_with_adk_agent(runner, text, user_id, reply_token))
-            has_accepted = True
+            if await handler(ev):
+                has_accepted = True
         except Exception as e:
-            print(f"[ERROR] Webhook event handling failed: {e}")
+            logger.error("[ERROR] Webhook event handling failed: %s", e)
             continue
 
     # ส่งการตอบกลับสถานะ
@@ -476,51 +902,12 @@ async def webhook(request: Request):
         return JSONResponse({"status": "ignored"})
     return JSONResponse({"status": "ok"})
 
-async def process_with_adk_agent(runner, message_text, user_id, reply_token):
-    """
-    ประมวลผลข้อความผู้ใช้ด้วย ADK agent
-    
-    ฟังก์ชันนี้จะส่งข้อความของผู้ใช้ไปยัง ADK agent เพื่อประมวลผลและตอบกลับ
-    
-    Args:
-        runner: ออบเจ็กต์ Runner ที่ใช้ในการประมวลผล
-        message_text: ข้อความที่ผู้ใช้ส่งมา
-        user_id: ID ของผู้ใช้
-        reply_token: Token สำหรับตอบกลับข้อความโดยเฉพาะ
-    """
-    # บันทึกข้อมูลการเริ่มประมวลผล
-    print(f"[INFO] ADK start user={user_id} text='{message_text}'")
- 
-    # สร้างหรือเรียกใช้เซสชัน
-    session_id = user_id
-    try:
-        await runner.session_service.create_session(app_name=APP_NAME, user_id=user_id, session_id=session_id)
-    except Exception:
-        pass
- 
-    # ดึงบริบทการสนทนาก่อนหน้า
-    try:
-        ctx = build_memory_context(user_id, limit=8)
-    except Exception:
-        ctx = None
- 
-    # ตรวจสอบว่าผู้ใช้ต้องการข้อมูล Flex Message หรือไม่
-    # ตรวจสอบว่าผู้ใช้ต้องการข้อมูล Flex Message หรือไม่
-    lt = (message_text or "").lower()
-    user_ask_flex = (
-        ("flex" in lt)
-        or ("เฟล็ก" in message_text)
-        or ("เฟลก" in message_text)
-        or ("การ์ด" in message_text)
-        or ("เมนู" in message_text)
-        or ("โปร" in message_text)
-        or ("โปรโมชัน" in message_text or "โปรโมชั่น" in message_text)
-        or ("คูปอง" in message_text)
-    )
-    
-    if user_ask_flex:
-        # กำหนดคำแนะนำสำหรับการสร้าง Flex Message
-        flex_instruction = """
+# คำสำคัญที่บ่งบอกว่าผู้ใช้ต้องการ Flex Message (คอมไพล์ครั้งเดียวตอน import)
+FLEX_RE = re.compile("flex|เฟล็ก|เฟลก|การ์ด|เมนู|โปร|โปรโมชัน|โปรโมชั่น|คูปอง", re.IGNORECASE)
+
+# คำแนะนำที่ต่อท้ายข้อความของผู้ใช้เมื่อผู้ใช้ต้องการ Flex Message
+FLEX_INSTRUCTION = """
+
 คุณต้องตอบกลับเป็น JSON message object สำหรับ LINE Messaging API เท่านั้น
 โครงสร้างต้องเป็นดังนี้:
 {
@@ -535,18 +922,86 @@ async def process_with_adk_agent(runner, message_text, user_id, reply_token):
 
 ห้ามตอบเป็นข้อความปกติเด็ดขาด ต้องเป็น JSON เท่านั้น
 """
-        # เตรียมข้อความสำหรับส่งไปยัง agent พร้อมบริบทและคำแนะนำ
-        prepared_text = f"{ctx}\n\nคำถามล่าสุด: {message_text}\n{flex_instruction}" if ctx else f"{message_text}\n{flex_instruction}"
+
+# คำแนะนำที่ต่อท้ายข้อความทั่วไป ให้ agent ตอบกลับผ่าน MCP tool
+MCP_INSTRUCTION = "\nกรุณาใช้ MCP tool ในการตอบกลับข้อความ"
+
+# ตัวคั่นระหว่างบริบทการสนทนาก่อนหน้าและคำถามล่าสุด
+CONTEXT_QUESTION_SEPARATOR = "\n\nคำถามล่าสุด: "
+
+# Part คงที่ที่ใช้ซ้ำในทุกข้อความที่ส่งให้ agent (ข้อความของผู้ใช้จะอยู่ใน Part ของตัวเองแยกจากคำแนะนำ)
+_FLEX_INSTRUCTION_PART = Part(text=FLEX_INSTRUCTION)
+_MCP_INSTRUCTION_PART = Part(text=MCP_INSTRUCTION)
+_CONTEXT_QUESTION_PART = Part(text=CONTEXT_QUESTION_SEPARATOR)
+
+async def _evict_idle_sessions(runner) -> None:
+    """
+    ลบเซสชันที่ไม่ได้ใช้งานนานที่สุดออกจาก session service เมื่อจำนวนเกิน SESSION_CACHE_MAX_ENTRIES
+    
+    เพื่อไม่ให้หน่วยความจำของ InMemorySessionService โตขึ้นเรื่อยๆ ตามจำนวนผู้ใช้
+    (บริบทการสนทนายังคงอยู่ในฐานข้อมูล memory)
+    
+    Args:
+        runner: ออบเจ็กต์ Runner ที่ใช้ในการประมวลผล
+    """
+    while len(_KNOWN_SESSIONS) > SESSION_CACHE_MAX_ENTRIES:
+        (app_name, user_id, session_id), _ = _KNOWN_SESSIONS.popitem(last=False)
+        try:
+            await runner.session_service.delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+        except Exception as e:
+            logger.warning("[SESSION][WARN] delete failed user=%s: %s", user_id, e)
+
+async def process_with_adk_agent(runner, ev: IncomingEvent):
+    """
+    ประมวลผลข้อความผู้ใช้ด้วย ADK agent
+    
+    ฟังก์ชันนี้จะส่งข้อความของผู้ใช้ไปยัง ADK agent เพื่อประมวลผลและตอบกลับ
+    
+    Args:
+        runner: ออบเจ็กต์ Runner ที่ใช้ในการประมวลผล
+        ev: เหตุการณ์ข้อความที่ผ่านการตรวจสอบแล้วจาก /webhook
+    """
+    message_text = ev.text
+    user_id = ev.user_id
+    # ผู้ใช้ต้องการข้อมูล Flex Message หรือไม่ (ตรวจไว้แล้วตอนรับเหตุการณ์)
+    user_ask_flex = ev.ask_flex
+
+    # บันทึกข้อมูลการเริ่มประมวลผล
+    logger.info("[INFO] ADK start user=%s text=%r", user_id, message_text)
+
+    # ดึงบริบทการสนทนาก่อนหน้า (ส่งไปเธรดเฉพาะเมื่อต้อง query ฐานข้อมูล)
+    try:
+        found, ctx = _cached_memory_context(user_id, 8)
+        if not found:
+            ctx = await asyncio.to_thread(_load_memory_context, user_id, 8)
+        ctx = ctx or ""
+    except Exception:
+        ctx = ""
+ 
+    # เรียกใช้เซสชันเดิม หรือสร้างใหม่ถ้ายังไม่มี (ไม่สร้างทับเซสชันเดิมที่มีประวัติอยู่แล้ว)
+    session_id = user_id
+    session_key = (APP_NAME, user_id, session_id)
+    if session_key in _KNOWN_SESSIONS:
+        _KNOWN_SESSIONS.move_to_end(session_key)
     else:
-        # สำหรับข้อความทั่วไป ให้ใช้ MCP tool
-        mcp_instruction = "\nกรุณาใช้ MCP tool ในการตอบกลับข้อความ"
-        prepared_text = f"{ctx}\n\nคำถามล่าสุด: {message_text}{mcp_instruction}" if ctx else f"{message_text}{mcp_instruction}"
+        try:
+            session = await runner.session_service.get_session(app_name=APP_NAME, user_id=user_id, session_id=session_id)
+            if session is None:
+                await runner.session_service.create_session(app_name=APP_NAME, user_id=user_id, session_id=session_id)
+            _KNOWN_SESSIONS[session_key] = None
+        except Exception as e:
+            logger.warning("[SESSION][WARN] get/create failed: %s", e)
+        await _evict_idle_sessions(runner)
+ 
+    # เตรียมข้อความสำหรับส่งไปยัง agent เป็น Part แยกกัน: บริบท, ข้อความของผู้ใช้ และคำแนะนำ
+    # (ไม่ต้องต่อสตริงบริบทที่อาจยาว และข้อความของผู้ใช้ไม่ปนกับคำแนะนำของระบบ)
+    parts = [Part(text=ctx), _CONTEXT_QUESTION_PART] if ctx else []
+    parts.append(Part(text=message_text))
+    # คำแนะนำสำหรับสร้าง Flex Message หรือให้ใช้ MCP tool สำหรับข้อความทั่วไป
+    parts.append(_FLEX_INSTRUCTION_PART if user_ask_flex else _MCP_INSTRUCTION_PART)
  
     # บันทึกข้อความของผู้ใช้ลงในประวัติการสนทนา
-    try:
-        memory_add_message(user_id, "user", message_text)
-    except Exception:
-        pass
+    memory_add_message(user_id, "user", message_text)
  
     # ตัวแปรสำหรับเก็บผลลัพธ์
     final_text = None
@@ -557,150 +1012,126 @@ async def process_with_adk_agent(runner, message_text, user_id, reply_token):
     agen = runner.run_async(
         user_id=user_id,
         session_id=session_id,
-        new_message=Content(parts=[Part(text=prepared_text)], role="user"),
+        new_message=Content(parts=parts, role="user"),
     )
-    try:
-        # รับผลลัพธ์จาก agent แบบ streaming
-        async for event in agen:
-            evtype = getattr(event, "event_type", "")
-            if evtype == "tool_response":
-                tool_done = True
-                break
+
+    async def _drain_stream():
+        # รับผลลัพธ์จาก agent แบบ streaming และหยุดทันทีเมื่อ tool ทำงานหรือได้คำตอบสุดท้าย
+        nonlocal final_text, tool_done
+        try:
+            async for event in agen:
+                evtype = getattr(event, "event_type", "")
+                if evtype == "tool_response":
+                    tool_done = True
+                    break
+                try:
+                    if event.is_final_response() and event.content:
+                        final_text = event.content.parts[0].text if event.content.parts else None
+                except Exception:
+                    pass
+                if final_text:
+                    break
+        finally:
+            # ปิด agent stream ใน task เดียวกับที่วนอ่าน (wait_for รันฟังก์ชันนี้ใน task ลูก)
+            # เพื่อให้ context ที่ stream ตั้งไว้ (เช่น tracing span) ถูกคืนค่าใน Context เดิม
             try:
-                if event.is_final_response() and event.content:
-                    final_text = event.content.parts[0].text if event.content.parts else None
+                await agen.aclose()
             except Exception:
                 pass
+
+    try:
+        # จำกัดเวลารอ เพื่อไม่ให้ stream ที่ค้างยึด slot ของ semaphore ไว้ตลอด
+        await asyncio.wait_for(_drain_stream(), timeout=AGENT_STREAM_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning("[TIMEOUT] Agent stream exceeded %ss for user=%s", AGENT_STREAM_TIMEOUT_SECONDS, user_id)
     except McpError as e:
         # จัดการข้อผิดพลาดจาก MCP
-        print(f"[TOOL ERROR] MCP: {e}")
+        logger.error("[TOOL ERROR] MCP: %s", e)
     except Exception as e:
         # จัดการข้อผิดพลาดทั่วไป
-        print(f"[ERROR] Agent stream: {e}")
+        logger.error("[ERROR] Agent stream: %s", e)
 
         se = str(e)
         if "RESOURCE_EXHAUSTED" in se or "429" in se:
             resource_exhausted = True
-    finally:
-        # ปิด agent stream
-        try:
-            await agen.aclose()
-        except Exception:
-            pass
 
     # ถ้า tool ทำงานสำเร็จ
     if tool_done:
-        print("[OK] Tool executed via MCP.")
+        logger.info("[OK] Tool executed via MCP.")
 
         # บันทึกการตอบกลับลงในประวัติการสนทนา
-        try:
-            memory_add_message(user_id, "assistant", "(ส่งข้อความผ่าน MCP สำเร็จ)")
-        except Exception:
-            pass
+        memory_add_message(user_id, "assistant", "(ส่งข้อความผ่าน MCP สำเร็จ)")
         return
 
     # แสดงข้อความที่ได้จาก LLM เพื่อการดีบัก
-    print(f"[DEBUG] final_text from LLM: {repr(final_text)}")
+    logger.debug("[DEBUG] final_text from LLM: %r", final_text)
     
     # ถ้ามีข้อความตอบกลับจาก LLM
     if final_text:
         # พยายามแปลงข้อความเป็น message object
         msg_obj = _try_parse_message_obj(final_text)
         if msg_obj:
-            print(f"[DEBUG] Parsed msg_obj: {msg_obj}")
+            logger.debug("[DEBUG] Parsed msg_obj: %s", msg_obj)
             
             # ตรวจสอบโครงสร้าง JSON ว่าถูกต้องหรือไม่
             if msg_obj.get("type") == "flex" and "contents" in msg_obj and "altText" in msg_obj:
-                print("[DEBUG] Valid Flex message structure")
+                logger.debug("[DEBUG] Valid Flex message structure")
                 # ส่ง Flex message ไปยังผู้ใช้โดยใช้ reply token
-                ok = _fallback_push_line_message(user_id, msg_obj, reply_token)
-                print("[FALLBACK PARSED OK]" if ok else "[FALLBACK PARSED FAIL]")
+                ok = await _fallback_push_line_message(user_id, msg_obj, _usable_reply_token(ev))
+                logger.info("[FALLBACK PARSED OK]" if ok else "[FALLBACK PARSED FAIL]")
                 if ok:
                     # บันทึกการตอบกลับลงในประวัติการสนทนา
-                    try:
-                        memory_add_message(user_id, "assistant", "(ส่ง Flex message สำเร็จ)")
-                    except Exception:
-                        pass
+                    memory_add_message(user_id, "assistant", "(ส่ง Flex message สำเร็จ)")
                     return
             elif msg_obj.get("type") == "text" and "text" in msg_obj:
                 # ตรวจสอบว่าเป็นข้อความธรรมดาที่มีโครงสร้างถูกต้อง
-                print("[DEBUG] Valid Text message structure")
-                ok = _fallback_push_line_message(user_id, msg_obj, reply_token)
-                print("[FALLBACK PARSED OK]" if ok else "[FALLBACK PARSED FAIL]")
+                logger.debug("[DEBUG] Valid Text message structure")
+                ok = await _fallback_push_line_message(user_id, msg_obj, _usable_reply_token(ev))
+                logger.info("[FALLBACK PARSED OK]" if ok else "[FALLBACK PARSED FAIL]")
                 if ok:
                     # บันทึกการตอบกลับลงในประวัติการสนทนา
-                    try:
-                        memory_add_message(user_id, "assistant", msg_obj.get("text", "(ส่งข้อความสำเร็จ)"))
-                    except Exception:
-                        pass
+                    memory_add_message(user_id, "assistant", msg_obj.get("text", "(ส่งข้อความสำเร็จ)"))
                     return
             else:
                 # โครงสร้างข้อความไม่ถูกต้อง
-                print("[DEBUG] Invalid message structure:", msg_obj)
+                logger.debug("[DEBUG] Invalid message structure: %s", msg_obj)
         else:
             # ไม่สามารถแปลงข้อความเป็น JSON ได้
-            print("[DEBUG] Failed to parse final_text as JSON message object:", final_text[:200])
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[DEBUG] Failed to parse final_text as JSON message object: %s", final_text[:200])
  
     # กรณีทรัพยากรหมด (resource exhausted) แต่ผู้ใช้ต้องการ Flex message
     if resource_exhausted:
         # ตรวจสอบว่าผู้ใช้ต้องการ Flex message หรือไม่จากคำสำคัญในข้อความ
-        lt = (message_text or "").lower()
-        wants_flex = (
-            ("flex" in lt)
-            or ("เฟล็ก" in message_text)
-            or ("เฟลก" in message_text)
-            or ("การ์ด" in message_text)
-            or ("เมนู" in message_text)
-            or ("โปร" in message_text)
-            or ("โปรโมชัน" in message_text or "โปรโมชั่น" in message_text)
-            or ("คูปอง" in message_text)
-        )
-        if wants_flex:
+        if user_ask_flex:
             # ส่ง Flex message ตัวอย่างเมื่อทรัพยากรหมด
-            ok = _send_demo_flex(user_id, reply_token)
-            print("[FALLBACK DEMO FLEX OK]" if ok else "[FALLBACK DEMO FLEX FAIL]")
+            ok = await _send_demo_flex(user_id, _usable_reply_token(ev))
+            logger.info("[FALLBACK DEMO FLEX OK]" if ok else "[FALLBACK DEMO FLEX FAIL]")
             if ok:
-                try:
-                    memory_add_message(user_id, "assistant", "(ส่ง Flex ตัวอย่างแบบสำรอง เนื่องจากโควต้าหมด)")
-                except Exception:
-                    pass
+                memory_add_message(user_id, "assistant", "(ส่ง Flex ตัวอย่างแบบสำรอง เนื่องจากโควต้าหมด)")
                 return
 
     # กรณี user ขอ Flex แต่ไม่ได้รับ JSON message จาก LLM ให้ส่ง Flex demo ทันที
-    lt = (message_text or "").lower()
-    user_ask_flex = (
-        ("flex" in lt)
-        or ("เฟล็ก" in message_text)
-        or ("เฟลก" in message_text)
-        or ("การ์ด" in message_text)
-        or ("เมนู" in message_text)
-        or ("โปร" in message_text)
-        or ("โปรโมชัน" in message_text or "โปรโมชั่น" in message_text)
-        or ("คูปอง" in message_text)
-    )
     if user_ask_flex and final_text and not msg_obj:
         # ส่ง Flex demo ทันทีเมื่อผู้ใช้ขอ Flex แต่ไม่ได้รับ JSON message
-        print("[FALLBACK DEMO FLEX] ส่ง Flex demo ทันที (user ขอ Flex แต่ไม่ได้รับ JSON message)")
-        ok = _send_demo_flex(user_id)
+        logger.info("[FALLBACK DEMO FLEX] ส่ง Flex demo ทันที (user ขอ Flex แต่ไม่ได้รับ JSON message)")
+        ok = await _send_demo_flex(user_id, _usable_reply_token(ev))
         if ok:
-            try:
-                memory_add_message(user_id, "assistant", "(ส่ง Flex demo ทันที เนื่องจากขอ Flex แต่ไม่ได้รับ JSON message)")
-            except Exception:
-                pass
+            memory_add_message(user_id, "assistant", "(ส่ง Flex demo ทันที เนื่องจากขอ Flex แต่ไม่ได้รับ JSON message)")
             return
 
     # ถ้ายังไม่สำเร็จ ให้ fallback ส่งข้อความสุดท้ายที่มี หรือส่งข้อความแจ้งเตือนสั้น ๆ เป็นข้อความธรรมดา
     text_to_send = final_text or "ขออภัย เกิดข้อผิดพลาดในการส่งข้อความ ลองใหม่อีกครั้งนะครับ/ค่ะ"
-    ok = _fallback_push_line_text(user_id, text_to_send)
-    print("[FALLBACK OK]" if ok else "[FALLBACK FAIL]", (text_to_send or "")[:80])
+    ok = await _fallback_push_line_text(user_id, text_to_send, _usable_reply_token(ev))
+    logger.info("%s %s", "[FALLBACK OK]" if ok else "[FALLBACK FAIL]", text_to_send[:80])
 
     # บันทึกฝั่งผู้ช่วย (กรณี fallback)
-    try:
-        memory_add_message(user_id, "assistant", text_to_send)
-    except Exception:
-        pass
+    memory_add_message(user_id, "assistant", text_to_send)
     return
  
+# ตัวถอดรหัส JSON ที่ใช้ซ้ำใน _try_parse_message_obj (สร้างครั้งเดียวตอน import)
+_JSON_DECODER = json.JSONDecoder()
+
 def _try_parse_message_obj(text: str) -> Optional[Dict[str, Any]]:
     """
     พยายามแปลงข้อความเป็นวัตถุ JSON ที่มีโครงสร้างถูกต้องสำหรับการส่งข้อความ
@@ -711,60 +1142,61 @@ def _try_parse_message_obj(text: str) -> Optional[Dict[str, Any]]:
     Returns:
         Optional[Dict[str, Any]]: วัตถุข้อความที่แปลงแล้ว หรือ None ถ้าแปลงไม่สำเร็จ
     """
-    # แสดงข้อความดิบเพื่อการดีบัก
-    print(f"[DEBUG] Raw text to parse: {repr(text[:100])}...")
-    
-    # ค้นหา JSON ในข้อความ
-    json_start = None
-    
-    # ค้นหา code block ที่มี JSON
-    json_block_match = re.search(r'```(?:json)?\s*\n(.*?)\n\s*```', text, re.DOTALL)
-    if json_block_match:
+    # ค้นหา JSON object ตั้งแต่เครื่องหมาย { แต่ละตัวในข้อความ
+    # raw_decode จะหยุดเมื่อจบ object จึงรองรับทั้ง code fence และข้อความที่ต่อท้าย JSON
+    json_start = text.find('{')
+    while json_start >= 0:
         try:
-            raw = json_block_match.group(1).strip()
-            print(f"[DEBUG] Found JSON in code block: {repr(raw[:100])}...")
-            obj = json.loads(raw)
-            if isinstance(obj, dict):
-                # รองรับทั้งรูปแบบ {"type": "text", "text": "..."} และ {"message": {"type": "text", "text": "..."}}
-                if "message" in obj and isinstance(obj["message"], dict):
-                    msg = obj["message"]
-                    print(f"[DEBUG] Using nested message format: {msg}")
-                    return msg
-                elif "type" in obj:
-                    # กรณีที่เป็น message object โดยตรง
-                    print(f"[DEBUG] Using direct message format: {obj}")
-                    return obj
-        except Exception as e:
-            print(f"[DEBUG] JSON parse error in code block: {e}")
-    
-    # ค้นหา JSON โดยตรงในข้อความ (ไม่มี code block)
-    try:
-        # ค้นหาเครื่องหมาย { แรกในข้อความ
-        json_start = text.find('{')
-        if json_start >= 0:
-            # ตัดข้อความตั้งแต่ { ไปจนจบ
-            potential_json = text[json_start:]
-            print(f"[DEBUG] Found potential JSON starting at position {json_start}: {repr(potential_json[:100])}...")
-            obj = json.loads(potential_json)
-            if isinstance(obj, dict):
-                # รองรับทั้งรูปแบบ {"type": "text", "text": "..."} และ {"message": {"type": "text", "text": "..."}}
-                if "message" in obj and isinstance(obj["message"], dict):
-                    msg = obj["message"]
-                    print(f"[DEBUG] Using nested message format: {msg}")
-                    return msg
-                elif "type" in obj:
-                    # กรณีที่เป็น message object โดยตรง
-                    print(f"[DEBUG] Using direct message format: {obj}")
-                    return obj
-    except Exception as e:
-        print(f"[DEBUG] JSON parse error in direct text: {e}")
+            obj, end = _JSON_DECODER.raw_decode(text, json_start)
+        except ValueError:
+            json_start = text.find('{', json_start + 1)
+            continue
+        if isinstance(obj, dict):
+            # รองรับทั้งรูปแบบ {"type": "text", "text": "..."} และ {"message": {"type": "text", "text": "..."}}
+            if "message" in obj and isinstance(obj["message"], dict):
+                return obj["message"]
+            elif "type" in obj:
+                # กรณีที่เป็น message object โดยตรง
+                return obj
+        # object ที่ไม่ใช่รูปแบบข้อความ ให้ค้นหาต่อหลังจบ object นั้น (ไม่ค้นหาภายใน object ที่แปลงแล้ว)
+        json_start = text.find('{', end)
     
     # ถ้าไม่พบ JSON ที่ถูกต้อง
-    print("[DEBUG] Failed to parse final_text as JSON message object:", text[:100])
     return None
 
 
-def _fallback_push_line_message(user_id: str, message: Dict[str, Any], reply_token: Optional[str] = None) -> bool:
+async def _post_line_message(url: str, data: bytes, tag: str) -> bool:
+    """
+    ส่ง payload ที่แปลงเป็น JSON bytes แล้วไปยัง LINE Messaging API
+    
+    Args:
+        url (str): endpoint ของ LINE (push หรือ reply)
+        data (bytes): JSON payload
+        tag (str): prefix ของ log เช่น [FALLBACK][MSG]
+        
+    Returns:
+        bool: True ถ้าส่งสำเร็จ, False ถ้าล้มเหลว
+    """
+    try:
+        resp = await _LINE_CLIENT.post(url, content=data)
+        code = resp.status_code
+        if not (200 <= code < 300):
+            # จัดการกรณีเกิด HTTP error (แปลง body เฉพาะเมื่อจะถูกบันทึกลง log จริง)
+            if logger.isEnabledFor(logging.WARNING):
+                try:
+                    detail = orjson.loads(resp.content)
+                except orjson.JSONDecodeError:
+                    detail = resp.text
+                logger.warning("%s[HTTPError] %s: %s", tag, code, detail)
+            return False
+        logger.info("%s HTTP %s", tag, code)
+        return True
+    except Exception as e:
+        # จัดการกรณีเกิดข้อผิดพลาดอื่นๆ
+        logger.error("%s[ERROR] %s", tag, e)
+        return False
+
+async def _fallback_push_line_message(user_id: str, message: Dict[str, Any], reply_token: Optional[str] = None) -> bool:
     """
     ส่งข้อความตามโครงสร้างที่เอเจนต์อาจส่งมาเป็น JSON ข้อความ (แทนที่จะเรียกเครื่องมือจริง)
     รองรับ:
@@ -780,20 +1212,20 @@ def _fallback_push_line_message(user_id: str, message: Dict[str, Any], reply_tok
         bool: True ถ้าส่งสำเร็จ, False ถ้าล้มเหลว
     """
     try:
-        token = LINE_CHANNEL_ACCESS_TOKEN
-        if not token or not user_id:
-            print("[FALLBACK][ERROR] Missing token or user_id")
+        if not user_id:
+            logger.error("[FALLBACK][ERROR] Missing user_id")
             return False
 
         payload_message: Optional[Dict[str, Any]] = None
 
         # ตรวจสอบประเภทข้อความและสร้าง payload ตามประเภท
         mtype = (message.get("type") or "").lower()
-        if mtype == "text" and isinstance(message.get("text"), str):
+        text = message.get("text")
+        if mtype == "text" and isinstance(text, str):
             # สร้าง payload สำหรับข้อความธรรมดา
             payload_message = {
                 "type": "text",
-                "text": (message.get("text") or "")[:5000],  # จำกัดความยาวข้อความไม่เกิน 5000 ตัวอักษร
+                "text": text[:5000],  # จำกัดความยาวข้อความไม่เกิน 5000 ตัวอักษร (ถ้าสั้นกว่าจะได้สตริงเดิมโดยไม่คัดลอก)
             }
         elif "contents" in message and "altText" in message:
             # สร้าง payload สำหรับ Flex message
@@ -807,106 +1239,47 @@ def _fallback_push_line_message(user_id: str, message: Dict[str, Any], reply_tok
 
         # ส่งข้อความไปยัง LINE Messaging API
         if reply_token:
-            # ใช้ reply message ถ้ามี reply token
-            url = "https://api.line.me/v2/bot/message/reply"
+            # ใช้ reply message ถ้ามี reply token (ไม่กินโควต้า push)
+            url = LINE_REPLY_URL
+            tag = "[FALLBACK][REPLY]"
             payload = {
                 "replyToken": reply_token,
                 "messages": [payload_message],
             }
         else:
             # ใช้ push message ถ้าไม่มี reply token (fallback)
-            url = "https://api.line.me/v2/bot/message/push"
+            url = LINE_PUSH_URL
+            tag = "[FALLBACK][MSG]"
             payload = {
                 "to": user_id,
                 "messages": [payload_message],
             }
-        data = json.dumps(payload).encode("utf-8")
-        req = urllib.request.Request(
-            url,
-            data=data,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {token}",
-            },
-            method="POST",
-        )
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            code = getattr(resp, "status", resp.getcode())
-            print(f"[FALLBACK][MSG] HTTP {code}")
-            return 200 <= int(code) < 300
-    except urllib.error.HTTPError as e:
-        # จัดการกรณีเกิด HTTP error
-        body = e.read().decode("utf-8", errors="ignore") if hasattr(e, "read") else str(e)
-        print(f"[FALLBACK][MSG][HTTPError] {e.code}: {body}")
-        return False
+        return await _post_line_message(url, orjson.dumps(payload), tag)
     except Exception as e:
         # จัดการกรณีเกิดข้อผิดพลาดอื่นๆ
-        print(f"[FALLBACK][MSG][ERROR] {e}")
+        logger.error("[FALLBACK][MSG][ERROR] %s", e)
         return False
 
-def _fallback_push_line_text(user_id: str, text: str) -> bool:
+async def _fallback_push_line_text(user_id: str, text: str, reply_token: Optional[str] = None) -> bool:
     """
     ส่งข้อความ TEXT โดยตรงไปยัง LINE Messaging API (fallback กรณี Agent ไม่เรียกเครื่องมือ)
     
     Args:
         user_id (str): ID ของผู้ใช้ที่จะส่งข้อความไปหา
         text (str): ข้อความที่จะส่ง
+        reply_token (Optional[str]): Token สำหรับตอบกลับข้อความโดยเฉพาะ ถ้ามีจะใช้ reply แทน push
         
     Returns:
         bool: True ถ้าส่งสำเร็จ, False ถ้าล้มเหลว
     """
-    try:
-        token = LINE_CHANNEL_ACCESS_TOKEN
-        if not token or not user_id:
-            print("[FALLBACK][ERROR] Missing token or user_id")
-            return False
-        
-        # ส่งข้อความไปยัง LINE Messaging API
-        url = "https://api.line.me/v2/bot/message/push"
-        payload = {
-            "to": user_id,
-            "messages": [
-                {"type": "text", "text": (text or "")[:5000]}  # จำกัดความยาวข้อความไม่เกิน 5000 ตัวอักษร
-            ]
-        }
-        data = json.dumps(payload).encode("utf-8")
-        req = urllib.request.Request(
-            url,
-            data=data,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {token}",
-            },
-            method="POST",
-        )
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            code = getattr(resp, "status", resp.getcode())
-            print(f"[FALLBACK] HTTP {code}")
-            return 200 <= int(code) < 300
-    except urllib.error.HTTPError as e:
-        # จัดการกรณีเกิด HTTP error
-        body = e.read().decode("utf-8", errors="ignore") if hasattr(e, "read") else str(e)
-        print(f"[FALLBACK][HTTPError] {e.code}: {body}")
-        return False
-    except Exception as e:
-        # จัดการกรณีเกิดข้อผิดพลาดอื่นๆ
-        print(f"[FALLBACK][ERROR] {e}")
-        return False
+    return await _fallback_push_line_message(user_id, {"type": "text", "text": text or ""}, reply_token)
 
 
-def _send_demo_flex(user_id: str, reply_token: Optional[str] = None) -> bool:
-    """
-    ส่ง Flex ตัวอย่างแบบง่าย โดยไม่เรียก LLM (ใช้ตอนโควต้าหมดหรือเป็นคำสั่งเดโม่)
-    
-    Args:
-        user_id (str): ID ของผู้ใช้ที่จะส่ง Flex message ไปหา
-        reply_token (Optional[str]): Token สำหรับตอบกลับข้อความโดยเฉพาะ ถ้ามีจะใช้ reply แทน push
-        
-    Returns:
-        bool: True ถ้าส่งสำเร็จ, False ถ้าล้มเหลว
-    """
-    # สร้าง Flex message ตัวอย่างแบบง่าย
-    demo_contents: Dict[str, Any] = {
+# Flex message ตัวอย่างแบบง่าย (สร้างและแปลงเป็น JSON ครั้งเดียวตอน import)
+_DEMO_FLEX_MESSAGE: Dict[str, Any] = {
+    "type": "flex",
+    "altText": "ตัวอย่างโปรโมชัน - ดูรายละเอียด",
+    "contents": {
         "type": "bubble",
         "body": {
             "type": "box",
@@ -918,13 +1291,38 @@ def _send_demo_flex(user_id: str, reply_token: Optional[str] = None) -> bool:
                 {"type": "button", "style": "primary", "margin": "md", "action": {"type": "uri", "label": "ดูรายละเอียด", "uri": "https://example.com/"}},
             ],
         },
-    }
-    msg = {
-        "altText": "ตัวอย่างโปรโมชัน - ดูรายละเอียด",
-        "contents": demo_contents,
-    }
+    },
+}
+# ส่วนท้ายของ payload ที่แปลงแล้ว ต่อท้าย "to" หรือ "replyToken" ตอนส่ง
+_DEMO_FLEX_PAYLOAD_TAIL = b',"messages":[' + orjson.dumps(_DEMO_FLEX_MESSAGE) + b']}'
+
+
+async def _send_demo_flex(user_id: str, reply_token: Optional[str] = None) -> bool:
+    """
+    ส่ง Flex ตัวอย่างแบบง่าย โดยไม่เรียก LLM (ใช้ตอนโควต้าหมดหรือเป็นคำสั่งเดโม่)
+    
+    Args:
+        user_id (str): ID ของผู้ใช้ที่จะส่ง Flex message ไปหา
+        reply_token (Optional[str]): Token สำหรับตอบกลับข้อความโดยเฉพาะ ถ้ามีจะใช้ reply แทน push
+        
+    Returns:
+        bool: True ถ้าส่งสำเร็จ, False ถ้าล้มเหลว
+    """
+    if not user_id:
+        logger.error("[FALLBACK][ERROR] Missing user_id")
+        return False
+
+    # ประกอบ payload จาก bytes ที่เตรียมไว้ (orjson.dumps ของสตริงจะ escape ค่าให้ถูกต้อง)
+    if reply_token:
+        url = LINE_REPLY_URL
+        tag = "[FALLBACK][REPLY]"
+        data = b'{"replyToken":' + orjson.dumps(reply_token) + _DEMO_FLEX_PAYLOAD_TAIL
+    else:
+        url = LINE_PUSH_URL
+        tag = "[FALLBACK][MSG]"
+        data = b'{"to":' + orjson.dumps(user_id) + _DEMO_FLEX_PAYLOAD_TAIL
     # ส่ง Flex message ตัวอย่าง
-    return _fallback_push_line_message(user_id, msg, reply_token)
+    return await _post_line_message(url, data, tag)
 
 
 if __name__ == "__main__":